@@ -1,10 +1,106 @@
+import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from pipeline_common import find_depletions_file, intermediate_depletions_file
 # No need to import uuid here anymore, as we're not generating them in this script
 
+# Number of depletions rows read and matched at a time.
+# Keeps memory use flat no matter how large the VIP export is.
+DEPLETIONS_CHUNK_SIZE = 200_000
+
+# Column types of depletions_final_for_import.csv.
+# The file is written by pyarrow's multi-threaded C++ CSV writer instead of to_csv.
+OUTPUT_SCHEMA = pa.schema([
+    ('account_id', pa.string()),
+    ('order_date', pa.string()),
+    ('cases', pa.float64()),
+    ('sku', pa.string())
+])
+
+def match_depletions_chunk(depletions_df, account_id_map):
+    """
+    Match one chunk of depletions rows to Supabase account IDs.
+
+    Returns a tuple of (final_df, unmatched_account_names, skipped_due_to_invalid_cases),
+    where final_df holds the matched rows in the output format.
+    """
+    # Normalize names the same way as the accounts (case-insensitive, strip spaces).
+    # Names repeat across many rows, so as a category each unique name is stored once.
+    depl_keys = depletions_df['std_account_name_for_lookup'].astype('string').str.lower().str.strip().astype('category')
+
+    # Look up only the unique names in one get_indexer call; the map's Index builds its
+    # hashtable once and reuses it for every chunk. Unmatched names get position -1.
+    # Rows then take their position through the category codes. Empty names have
+    # code -1, which picks the -1 appended at the end, so they stay unmatched.
+    category_positions = account_id_map.index.get_indexer(depl_keys.cat.categories)
+    positions = np.append(category_positions, -1)[depl_keys.cat.codes.to_numpy()]
+    # The None appended to the IDs is what position -1 picks, even when the map is empty
+    account_ids = np.append(account_id_map.to_numpy(dtype=object), None)[positions]
+    account_ids = pd.Series(account_ids, index=depletions_df.index)
+
+    # Invalid 'cases' values (non-numeric, empty) become NaN instead of raising.
+    # float64 turns Arrow nulls into NaN too, so the masks below are plain booleans.
+    cases = pd.to_numeric(depletions_df['cases'], errors='coerce').astype('float64')
+
+    matched_mask = account_ids.notna()
+    valid_cases_mask = cases.gt(0) # Assuming 0 cases is not a valid depletion to import
+
+    # Store original names for warning
+    unmatched_account_names = set(depletions_df.loc[~matched_mask, 'std_account_name_for_lookup'].unique())
+    skipped_due_to_invalid_cases = int((matched_mask & ~valid_cases_mask).sum())
+
+    keep_mask = matched_mask & valid_cases_mask
+    final_df = pd.DataFrame({
+        'account_id': account_ids[keep_mask],
+        'order_date': depletions_df.loc[keep_mask, 'order_date'],
+        'cases': cases[keep_mask],
+        'sku': depletions_df.loc[keep_mask, 'sku']
+    })
+
+    # Ensure data types are correct for Supabase
+    # Arrow-backed strings are stored in one contiguous buffer instead of one Python object per row
+    final_df['account_id'] = final_df['account_id'].astype('string[pyarrow]')
+    final_df['cases'] = final_df['cases'].astype(float) # Supabase numeric can take float
+    try:
+        # process_vip_export already writes YYYY-MM-DD, so parse with that exact format;
+        # cache=True parses each of the few distinct dates only once.
+        final_df['order_date'] = pd.to_datetime(final_df['order_date'], format='%Y-%m-%d', cache=True).dt.strftime('%Y-%m-%d')
+    except Exception as e:
+        print(f"Warning: Could not convert all 'order_date' values to YYYY-MM-DD format. Error: {e}")
+        print("Please check the 'order_date' column in the depletions file.")
+    final_df['sku'] = final_df['sku'].astype('string[pyarrow]')
+
+    return final_df, unmatched_account_names, skipped_due_to_invalid_cases
+
+def read_depletions_columns(depletions_file_name):
+    """
+    Return the column names of the depletions file without reading its rows.
+    """
+    if depletions_file_name.endswith('.parquet'):
+        return pq.read_schema(depletions_file_name).names
+    return pd.read_csv(depletions_file_name, nrows=0).columns
+
+def read_depletions_chunks(depletions_file_name):
+    """
+    Yield the depletions file as DataFrames of up to DEPLETIONS_CHUNK_SIZE rows,
+    with Arrow-backed columns.
+    """
+    if depletions_file_name.endswith('.parquet'):
+        for batch in pq.ParquetFile(depletions_file_name).iter_batches(batch_size=DEPLETIONS_CHUNK_SIZE):
+            yield batch.to_pandas(types_mapper=pd.ArrowDtype)
+    else:
+        # The pyarrow engine can't read in chunks, so the C parser is used here
+        # with Arrow-backed columns, which keeps the string columns compact.
+        yield from pd.read_csv(depletions_file_name, chunksize=DEPLETIONS_CHUNK_SIZE, dtype_backend='pyarrow')
+
 def merge_true_supabase_ids_with_depletions():
     """
     Merge Supabase account IDs (from accounts_with_supabase_ids.csv) with depletions data.
     Ensures data types are compatible with Supabase.
+    The depletions file is streamed in chunks of DEPLETIONS_CHUNK_SIZE rows.
     """
     print("Starting the merge process with true Supabase IDs...")
 
@@ -14,8 +110,9 @@ def merge_true_supabase_ids_with_depletions():
     accounts_file_name = 'accounts_with_supabase_ids.csv'
     try:
         print(f"Reading Supabase accounts data from: {accounts_file_name}")
-        # Ensure the 'id' column (Supabase UUID) is read as a string
-        accounts_df = pd.read_csv(accounts_file_name, dtype={'id': str})
+        # Ensure the 'id' column (Supabase UUID) is read as a string.
+        # The pyarrow engine parses the file on multiple threads.
+        accounts_df = pd.read_csv(accounts_file_name, dtype={'id': str}, engine='pyarrow')
         print(f"Successfully read {accounts_file_name}. Found {len(accounts_df)} accounts.")
     except FileNotFoundError:
         print(f"CRITICAL ERROR: The file '{accounts_file_name}' was not found.")
@@ -33,118 +130,100 @@ def merge_true_supabase_ids_with_depletions():
         print("This column is needed for matching.")
         return
 
-    # --- Step 2: Read the depletions file ---
-    # This is the output from your first script (unpivot_vip_data.py)
-    depletions_file_name = 'depletions_to_import.csv'
-    try:
-        print(f"Reading depletions data from: {depletions_file_name}")
-        depletions_df = pd.read_csv(depletions_file_name)
-        print(f"Successfully read {depletions_file_name}. Found {len(depletions_df)} depletions rows.")
-    except FileNotFoundError:
-        print(f"CRITICAL ERROR: The file '{depletions_file_name}' was not found.")
-        print("This file should be the output of your first script (e.g., unpivot_vip_data.py).")
+    # --- Step 2: Check the depletions file ---
+    # This is the output from your first script (unpivot_vip_data.py).
+    # Only the header is read here; the rows are streamed in Step 5.
+    depletions_file_name = find_depletions_file()
+    if depletions_file_name is None:
+        print(f"CRITICAL ERROR: The file '{intermediate_depletions_file()}' was not found.")
+        print("This file should be the output of your first script (process_vip_export.py).")
         return
+    print(f"Checking depletions data in: {depletions_file_name}")
+    depletions_columns = read_depletions_columns(depletions_file_name)
 
-    if 'std_account_name_for_lookup' not in depletions_df.columns: # Or whatever your lookup name column is
+    if 'std_account_name_for_lookup' not in depletions_columns: # Or whatever your lookup name column is
         print(f"CRITICAL ERROR: The 'std_account_name_for_lookup' column is missing in '{depletions_file_name}'.")
         print("This column is needed for matching.")
         return
 
     # --- Step 3: Prepare for matching (case-insensitive, strip spaces) ---
     print("Preparing account names for matching (lowercase, strip spaces)...")
-    accounts_df['match_col_accounts'] = accounts_df['std_account_name'].astype(str).str.lower().str.strip()
-    depletions_df['match_col_depletions'] = depletions_df['std_account_name_for_lookup'].astype(str).str.lower().str.strip()
+    accounts_keys = accounts_df['std_account_name'].astype('string').str.lower().str.strip()
 
-    # --- Step 4: Create a dictionary for faster lookups using the CORRECT Supabase IDs ---
-    # Key: normalized account name, Value: Supabase UUID
-    # Using 'match_col_accounts' as the key
+    # --- Step 4: Build the lookup map using the CORRECT Supabase IDs ---
+    # Index: normalized account name, Value: Supabase UUID.
+    # keep='last' matches the old dict behaviour, where later duplicates overwrote earlier ones.
+    # Accounts without a name can never be matched, so they are left out of the map.
     print("Creating account ID lookup map...")
-    account_id_map = dict(zip(accounts_df['match_col_accounts'], accounts_df['id']))
+    duplicate_mask = accounts_keys.notna() & accounts_keys.duplicated(keep=False)
+    if duplicate_mask.any():
+        duplicate_names = sorted(accounts_df.loc[duplicate_mask, 'std_account_name'].unique())
+        print(f"WARNING: {len(duplicate_names)} account names appear more than once in '{accounts_file_name}'. Their depletions will use the LAST matching ID:")
+        for name in duplicate_names[:10]: # Print first 10 for brevity
+            print(f"  - {name}")
+        if len(duplicate_names) > 10:
+            print(f"  ... and {len(duplicate_names) - 10} more.")
+    keep_mask = accounts_keys.notna() & ~accounts_keys.duplicated(keep='last')
+    account_id_map = pd.Series(accounts_df.loc[keep_mask, 'id'].to_numpy(dtype=object), index=pd.Index(accounts_keys[keep_mask]))
     print(f"Lookup map created with {len(account_id_map)} entries.")
 
-    # --- Step 5: Process each depletion row and match ---
+    # --- Step 5: Stream depletions in chunks, match them and append to the output ---
     print("Processing depletions and matching to accounts...")
-    matched_depletions_data = []
+    output_file_name = 'depletions_final_for_import.csv'
+    total_depletions = 0
+    matched_count = 0
     unmatched_account_names = set() # To store unique names that didn't match
     skipped_due_to_invalid_cases = 0
-
-    for _, row in depletions_df.iterrows():
-        # Use the normalized account name from depletions_df for lookup
-        normalized_lookup_name = row['match_col_depletions']
-        account_id_from_map = account_id_map.get(normalized_lookup_name) # Use .get() for safer lookup
-
-        if account_id_from_map is None:
-            unmatched_account_names.add(row['std_account_name_for_lookup']) # Store original name for warning
-            continue # Skip this depletion row if no account ID found
-
-        # Ensure cases is a valid number
-        try:
-            cases = float(row['cases'])
-            if pd.isna(cases) or cases <= 0: # Assuming 0 cases is not a valid depletion to import
-                # print(f"Debug: Invalid cases value for '{row['std_account_name_for_lookup']}': {row['cases']}")
-                skipped_due_to_invalid_cases +=1
-                continue
-        except (ValueError, TypeError):
-            # print(f"Debug: Invalid cases value (type error) for '{row['std_account_name_for_lookup']}': {row['cases']}")
-            skipped_due_to_invalid_cases += 1
-            continue
-
-        matched_depletions_data.append({
-            'account_id': account_id_from_map, # This is now the Supabase UUID
-            'order_date': row['order_date'],
-            'cases': cases,
-            'sku': row['sku']
-        })
-
-    # --- Step 6: Create the final DataFrame ---
-    if not matched_depletions_data:
+    sample_df = None
+    # Chunks go to a temporary file that only replaces the output once every chunk
+    # has been matched and written, so a failed run never leaves a partial import file.
+    temp_file_name = f'{output_file_name}.tmp'
+    try:
+        with pacsv.CSVWriter(temp_file_name, OUTPUT_SCHEMA) as writer:
+            for chunk in read_depletions_chunks(depletions_file_name):
+                final_df, chunk_unmatched, chunk_skipped = match_depletions_chunk(chunk, account_id_map)
+                total_depletions += len(chunk)
+                matched_count += len(final_df)
+                unmatched_account_names.update(chunk_unmatched)
+                skipped_due_to_invalid_cases += chunk_skipped
+                if sample_df is None and not final_df.empty:
+                    sample_df = final_df.head()
+                writer.write_table(pa.Table.from_pandas(final_df, schema=OUTPUT_SCHEMA, preserve_index=False))
+    except BaseException as e:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        if isinstance(e, OSError):
+            print(f"CRITICAL ERROR: Could not save the output file '{output_file_name}'. Error: {e}")
+            return
+        raise # Matching errors are not I/O problems, so let them surface as they are
+
+    print(f"Read {total_depletions} depletions rows from {depletions_file_name}.")
+
+    if matched_count == 0:
+        os.remove(temp_file_name)
         print("CRITICAL WARNING: No depletions were matched to accounts. The output file will be empty or not created.")
         print("Please check for warnings about unmatched account names and verify your input files.")
         return
 
-    final_df = pd.DataFrame(matched_depletions_data)
-    print(f"Created final DataFrame with {len(final_df)} matched depletions.")
+    os.replace(temp_file_name, output_file_name)
 
-    # --- Step 7: Ensure data types are correct for Supabase ---
-    print("Ensuring correct data types for final output...")
-    final_df['account_id'] = final_df['account_id'].astype(str) # Already string, but good practice
-    final_df['cases'] = final_df['cases'].astype(float) # Supabase numeric can take float
-    try:
-        final_df['order_date'] = pd.to_datetime(final_df['order_date']).dt.strftime('%Y-%m-%d')
-    except Exception as e:
-        print(f"Warning: Could not convert all 'order_date' values to YYYY-MM-DD format. Error: {e}")
-        print("Please check the 'order_date' column in 'depletions_to_import.csv'.")
-    final_df['sku'] = final_df['sku'].astype(str)
+    # --- Step 6: Report ---
+    print(f"\nProcessing complete:")
+    print(f"- Successfully processed for matching: {matched_count} depletions")
+    if unmatched_account_names:
+        print(f"- WARNING: Could not find Supabase IDs for {len(unmatched_account_names)} unique account names. These depletions were SKIPPED:")
+        for name in sorted(unmatched_account_names, key=str)[:10]: # Print first 10 for brevity
+             print(f"  - {name}")
+        if len(unmatched_account_names) > 10:
+            print(f"  ... and {len(unmatched_account_names) - 10} more.")
+    if skipped_due_to_invalid_cases > 0:
+        print(f"- Skipped {skipped_due_to_invalid_cases} depletions due to invalid or zero 'cases' values.")
+    print(f"- Output saved to: {output_file_name}")
 
-    # Optional: Remove any rows that might have become all NaN after processing (though less likely now)
-    # final_df = final_df.dropna(how='all')
-
-    # --- Step 8: Save to CSV ---
-    output_file_name = 'depletions_final_for_import.csv'
-    try:
-        final_df.to_csv(output_file_name, index=False)
-        print(f"\nProcessing complete:")
-        print(f"- Successfully processed for matching: {len(final_df)} depletions")
-        if unmatched_account_names:
-            print(f"- WARNING: Could not find Supabase IDs for {len(unmatched_account_names)} unique account names. These depletions were SKIPPED:")
-            for name in sorted(list(unmatched_account_names))[:10]: # Print first 10 for brevity
-                 print(f"  - {name}")
-            if len(unmatched_account_names) > 10:
-                print(f"  ... and {len(unmatched_account_names) - 10} more.")
-        if skipped_due_to_invalid_cases > 0:
-            print(f"- Skipped {skipped_due_to_invalid_cases} depletions due to invalid or zero 'cases' values.")
-        print(f"- Output saved to: {output_file_name}")
-
-        # Print a sample of the final data if it's not empty
-        if not final_df.empty:
-            print("\nSample of final data (first 5 rows):")
-            print(final_df.head().to_string())
-        else:
-            print("\nNote: The final output file is empty as no depletions could be fully processed and matched.")
-
-    except Exception as e:
-        print(f"CRITICAL ERROR: Could not save the output file '{output_file_name}'. Error: {e}")
+    # Print a sample of the final data
+    print("\nSample of final data (first 5 rows):")
+    print(sample_df.to_string())
 
 
 if __name__ == "__main__":
-    merge_true_supabase_ids_with_depletions()
\ No newline at end of file
+    merge_true_supabase_ids_with_depletions()
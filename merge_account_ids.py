@@ -1,61 +1,113 @@
+import hashlib
+import os
+import numpy as np
 import pandas as pd
-import uuid
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from pipeline_common import OUTPUT_BUFFER_SIZE, find_depletions_file, intermediate_depletions_file
+
+# SHA-256 of the accounts_to_import.csv that accounts_with_ids.csv was generated from
+ACCOUNTS_HASH_FILE = '.accounts_hash'
+
+def generate_uuid4_strings(count):
+    """
+    Generate count random version 4 UUID strings.
+    All random bytes come from a single os.urandom call instead of one uuid.uuid4() call per ID.
+    """
+    raw = np.frombuffer(bytearray(os.urandom(16 * count)), dtype=np.uint8).reshape(count, 16)
+    raw[:, 6] = (raw[:, 6] & 0x0f) | 0x40 # Version 4
+    raw[:, 8] = (raw[:, 8] & 0x3f) | 0x80 # RFC 4122 variant
+    hexed = raw.tobytes().hex()
+    return [
+        f"{hexed[i:i + 8]}-{hexed[i + 8:i + 12]}-{hexed[i + 12:i + 16]}-{hexed[i + 16:i + 20]}-{hexed[i + 20:i + 32]}"
+        for i in range(0, 32 * count, 32)
+    ]
 
 def merge_account_ids_with_depletions():
     """
     Merge account IDs with depletions data, creating a new CSV with the account IDs included.
     Generates UUIDs for accounts if they don't exist.
+    If accounts_to_import.csv is unchanged since the last run, the IDs saved in
+    accounts_with_ids.csv are reused instead of being generated and written again.
     """
     print("Reading input files...")
     
-    # Read the accounts file
-    accounts_df = pd.read_csv('accounts_to_import.csv')
+    # Read the accounts file (the pyarrow engine parses on multiple threads)
+    accounts_df = pd.read_csv('accounts_to_import.csv', engine='pyarrow')
     
     # Generate UUIDs for accounts if they don't exist
     if 'id' not in accounts_df.columns:
-        print("Generating UUIDs for accounts...")
-        accounts_df['id'] = [str(uuid.uuid4()) for _ in range(len(accounts_df))]
-        # Save the accounts with their new IDs
-        accounts_df.to_csv('accounts_with_ids.csv', index=False)
-        print("Saved accounts with generated IDs to accounts_with_ids.csv")
+        with open('accounts_to_import.csv', 'rb') as f:
+            accounts_hash = hashlib.sha256(f.read()).hexdigest()
+        saved_hash = None
+        if os.path.exists('accounts_with_ids.csv') and os.path.exists(ACCOUNTS_HASH_FILE):
+            with open(ACCOUNTS_HASH_FILE) as f:
+                saved_hash = f.read().strip()
+        
+        if saved_hash == accounts_hash:
+            # Same accounts as last run, so keep the IDs that were already saved
+            print("accounts_to_import.csv is unchanged, reusing IDs from accounts_with_ids.csv")
+            accounts_df = pd.read_csv('accounts_with_ids.csv', engine='pyarrow')
+        else:
+            print("Generating UUIDs for accounts...")
+            accounts_df['id'] = generate_uuid4_strings(len(accounts_df))
+            # Save the accounts with their new IDs
+            with open('accounts_with_ids.csv', 'w', buffering=OUTPUT_BUFFER_SIZE, newline='') as f:
+                accounts_df.to_csv(f, index=False, lineterminator='\n')
+            with open(ACCOUNTS_HASH_FILE, 'w') as f:
+                f.write(accounts_hash)
+            print("Saved accounts with generated IDs to accounts_with_ids.csv")
     
     # Read the depletions file
-    depletions_df = pd.read_csv('depletions_to_import.csv')
+    depletions_file_name = find_depletions_file()
+    if depletions_file_name is None:
+        print(f"Error: {intermediate_depletions_file()} not found!")
+        print("Run process_vip_export.py first to create the depletions file.")
+        return
+    print(f"Reading depletions from {depletions_file_name}")
+    if depletions_file_name.endswith('.parquet'):
+        depletions_df = pd.read_parquet(depletions_file_name, engine='pyarrow', dtype_backend='pyarrow')
+    else:
+        depletions_df = pd.read_csv(depletions_file_name, engine='pyarrow', dtype_backend='pyarrow')
     
     print(f"Found {len(accounts_df)} accounts and {len(depletions_df)} depletions")
     
-    # Create a dictionary for faster lookups
-    account_id_map = dict(zip(accounts_df['std_account_name'], accounts_df['id']))
+    # Warn about duplicate account names; like a dict, the last ID for a name wins.
+    # Accounts without a name can never be matched, so they are left out.
+    named_mask = accounts_df['std_account_name'].notna()
+    duplicate_mask = named_mask & accounts_df['std_account_name'].duplicated(keep='last')
+    if duplicate_mask.any():
+        duplicate_names = sorted(accounts_df.loc[duplicate_mask, 'std_account_name'].unique())
+        print(f"Warning: {len(duplicate_names)} account names appear more than once in accounts_to_import.csv. Their depletions will use the LAST matching ID:")
+        for account_name in duplicate_names[:10]: # Print first 10 for brevity
+            print(f"  - {account_name}")
+        if len(duplicate_names) > 10:
+            print(f"  ... and {len(duplicate_names) - 10} more.")
     
-    # Initialize list to store matched depletions
-    matched_depletions = []
-    skipped_count = 0
+    # Create a name -> ID lookup Series (Series.map uses a pandas hashtable, no Python dict)
+    keep_mask = named_mask & ~duplicate_mask
+    account_id_map = pd.Series(
+        accounts_df.loc[keep_mask, 'id'].to_numpy(),
+        index=accounts_df.loc[keep_mask, 'std_account_name'].to_numpy()
+    )
     
-    # Process each depletion row
-    for _, row in depletions_df.iterrows():
-        account_name = row['std_account_name_for_lookup']
-        account_id = account_id_map.get(account_name)
-        
-        if account_id is None:
-            print(f"Warning: No matching account ID found for '{account_name}'")
-            skipped_count += 1
-            continue
-            
-        matched_depletions.append({
-            'account_id': account_id,
-            'order_date': row['order_date'],
-            'cases': row['cases'],
-            'sku': row['sku']
-        })
+    # Match every depletion row to its account ID in one vectorized lookup
+    depletions_df['account_id'] = depletions_df['std_account_name_for_lookup'].map(account_id_map)
+    unmatched_mask = depletions_df['account_id'].isna()
+    skipped_count = int(unmatched_mask.sum())
+    
+    for account_name in depletions_df.loc[unmatched_mask, 'std_account_name_for_lookup'].unique():
+        print(f"Warning: No matching account ID found for '{account_name}'")
     
-    # Create the final DataFrame
-    final_df = pd.DataFrame(matched_depletions)
+    # Keep only the matched depletions
+    final_df = depletions_df.loc[~unmatched_mask, ['account_id', 'order_date', 'cases', 'sku']]
+    final_df = final_df.astype({'account_id': 'string[pyarrow]', 'sku': 'string[pyarrow]'})
     
-    # Save to CSV
-    final_df.to_csv('depletions_final_for_import.csv', index=False)
+    # Save to CSV with pyarrow's C++ writer, which is much faster than to_csv
+    pacsv.write_csv(pa.Table.from_pandas(final_df, preserve_index=False), 'depletions_final_for_import.csv')
     
     print(f"\nProcessing complete:")
-    print(f"- Successfully matched: {len(matched_depletions)} depletions")
+    print(f"- Successfully matched: {len(final_df)} depletions")
     print(f"- Skipped: {skipped_count} depletions")
     print(f"- Output saved to: depletions_final_for_import.csv")
 
@@ -0,0 +1,28 @@
+import os
+
+# File format for depletions_to_import, which is only read by the scripts in this repo.
+# 'parquet' is much faster to write and read back than 'csv' and keeps column types.
+INTERMEDIATE_FORMAT = 'parquet'
+
+# The tracked CSV version of the depletions file, used when no file in INTERMEDIATE_FORMAT exists
+FALLBACK_DEPLETIONS_FILE = 'depletions_to_import.csv'
+
+# Write buffer for the output CSVs, so large outputs go out in few write() calls.
+OUTPUT_BUFFER_SIZE = 4 * 1024 * 1024
+
+def intermediate_depletions_file():
+    """
+    Return the name process_vip_export.py writes the depletions file to.
+    """
+    return f'depletions_to_import.{INTERMEDIATE_FORMAT}'
+
+def find_depletions_file():
+    """
+    Return the depletions file to read, or None if there is none.
+    The file in INTERMEDIATE_FORMAT is always preferred; the CSV is only used when it is missing,
+    since git checkouts can make the tracked CSV look newer than a freshly written file.
+    """
+    for name in (intermediate_depletions_file(), FALLBACK_DEPLETIONS_FILE):
+        if os.path.exists(name):
+            return name
+    return None
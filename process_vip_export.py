@@ -1,37 +1,43 @@
 import pandas as pd
-from datetime import datetime, timedelta
 import os
+from pipeline_common import INTERMEDIATE_FORMAT, OUTPUT_BUFFER_SIZE, intermediate_depletions_file
+
+# Account columns in the VIP export (using correct capitalization and spacing)
+ACCOUNT_COLUMNS = [
+    'Retail Accounts',
+    'Classes of Trade',
+    'OnOff Premises',
+    'Address',
+    'City',
+    'State',
+    'Zip Code'
+]
 
 def process_vip_export(input_file, start_date_str, month_columns):
     """
     Process VIP export data and create two output files:
     1. accounts_to_import.csv - unique account information
-    2. depletions_to_import.csv - unpivoted depletion data
+    2. depletions_to_import.parquet (or .csv, see INTERMEDIATE_FORMAT in pipeline_common.py) - unpivoted depletion data
     
     Args:
         input_file (str): Path to the input VIP export CSV file
         start_date_str (str): Start date in YYYY-MM-DD format for the first month
+            (any day in that month; order dates use the first day of each month)
         month_columns (list): List of column names for monthly sales data
     """
-    # Read the input CSV file, using the second row as the header
+    # Read the input CSV file, using the second row as the header.
+    # Only the account and monthly columns are parsed.
     print(f"Reading {input_file}...")
-    df = pd.read_csv(input_file, header=1)
+    wanted_columns = set(ACCOUNT_COLUMNS) | set(month_columns)
+    df = pd.read_csv(input_file, header=1, usecols=lambda col: col in wanted_columns) # Missing month columns are reported below
     print("Columns in DataFrame:")
     print(list(df.columns))
     
     # 1. Create accounts_to_import.csv
     print("Creating accounts file...")
     
-    # Select and rename columns for accounts file (using correct capitalization and spacing)
-    accounts_df = df[[
-        'Retail Accounts',
-        'Classes of Trade',
-        'OnOff Premises',
-        'Address',
-        'City',
-        'State',
-        'Zip Code'
-    ]].copy()
+    # Select and rename columns for accounts file
+    accounts_df = df[ACCOUNT_COLUMNS].copy()
     
     # Rename columns to match required output format
     accounts_df.columns = [
@@ -44,49 +50,67 @@ def process_vip_export(input_file, start_date_str, month_columns):
         'zip_code'
     ]
     
-    # Remove duplicates and save
+    # Remove duplicates and save.
+    # This compares whole rows on purpose: chains (e.g. KYU, JING) share one std_account_name
+    # across several locations, so deduping on the name alone would drop real accounts.
     accounts_df = accounts_df.drop_duplicates()
-    accounts_df.to_csv('accounts_to_import.csv', index=False)
+    with open('accounts_to_import.csv', 'w', buffering=OUTPUT_BUFFER_SIZE, newline='') as f:
+        accounts_df.to_csv(f, index=False, lineterminator='\n')
     print(f"Saved {len(accounts_df)} unique accounts to accounts_to_import.csv")
     
-    # 2. Create depletions_to_import.csv
+    # 2. Create depletions_to_import
     print("Creating depletions file...")
     
-    # Get the start date
-    start_date = datetime.strptime(start_date_str, '%Y-%m-%d')
+    # Get the start date, anchored to the first day of its month
+    start_date = pd.to_datetime(start_date_str, format='%Y-%m-%d').to_period('M').start_time
     
-    # Create a list to store the unpivoted data
-    depletions_data = []
+    # One date per monthly column, stepping by calendar month from the start date
+    date_list = pd.date_range(start=start_date, periods=len(month_columns), freq='MS').strftime('%Y-%m-%d').tolist()
     
-    # Process each monthly column
+    # Only unpivot the monthly columns that are actually present
+    present_month_columns = []
+    date_map = {}
     for i, month_col in enumerate(month_columns):
         if month_col not in df.columns:
             print(f"Warning: Column {month_col} not found in input file")
             continue
-            
-        # Calculate the date for this month
-        current_date = start_date + timedelta(days=30 * i)
-        order_date = current_date.strftime('%Y-%m-%d')
-        
-        # Create a temporary dataframe for this month
-        month_df = df[['Retail Accounts', month_col]].copy()
-        month_df.columns = ['std_account_name_for_lookup', 'cases']
-        
-        # Add order_date and sku columns
-        month_df['order_date'] = order_date
-        month_df['sku'] = 'DEFAULT_SKU'
-        
-        # Filter out zero or empty cases
-        month_df = month_df[month_df['cases'].notna() & (month_df['cases'] != 0)]
-        
-        depletions_data.append(month_df)
-    
-    # Combine all monthly data
-    depletions_df = pd.concat(depletions_data, ignore_index=True)
-    
-    # Save to CSV
-    depletions_df.to_csv('depletions_to_import.csv', index=False)
-    print(f"Saved {len(depletions_df)} depletion records to depletions_to_import.csv")
+        present_month_columns.append(month_col)
+        date_map[month_col] = date_list[i]
+    
+    # Unpivot all monthly columns in a single pass
+    long_df = df.melt(
+        id_vars=['Retail Accounts'],
+        value_vars=present_month_columns,
+        var_name='_month_col',
+        value_name='cases'
+    )
+    
+    # Month columns with text values ("4,363", " -   ") come through as strings.
+    # Strip the thousands separators and turn anything still non-numeric into NaN,
+    # so every depletion has a numeric 'cases' value (Parquet also needs a single column type).
+    if not pd.api.types.is_numeric_dtype(long_df['cases']):
+        long_df['cases'] = long_df['cases'].astype('string').str.replace(',', '', regex=False)
+    long_df['cases'] = pd.to_numeric(long_df['cases'], errors='coerce').astype('float64')
+    
+    # Filter out zero or empty cases first, so order_date and sku are only built for kept rows
+    long_df = long_df.loc[long_df['cases'].notna() & long_df['cases'].ne(0)]
+    
+    # Add order_date and sku columns (the sku scalar is broadcast by the constructor)
+    depletions_df = pd.DataFrame({
+        'std_account_name_for_lookup': long_df['Retail Accounts'],
+        'cases': long_df['cases'],
+        'order_date': long_df['_month_col'].map(date_map),
+        'sku': 'DEFAULT_SKU'
+    })
+    
+    # Save in the intermediate format
+    depletions_file_name = intermediate_depletions_file()
+    if INTERMEDIATE_FORMAT == 'parquet':
+        depletions_df.to_parquet(depletions_file_name, engine='pyarrow', compression='zstd', index=False)
+    else:
+        with open(depletions_file_name, 'w', buffering=OUTPUT_BUFFER_SIZE, newline='') as f:
+            depletions_df.to_csv(f, index=False, lineterminator='\n')
+    print(f"Saved {len(depletions_df)} depletion records to {depletions_file_name}")
 
 if __name__ == "__main__":
     # Configuration